@@ -11,9 +11,45 @@ __author__ = 'David Poisl <david@poisl.at>'
 __version__ = '0.1.0'
 
 
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 from . import api
 
 
+try:
+    basestring
+except NameError:  # python 3
+    basestring = str
+
+
+metadata_cache = None
+"""cache.StaleCache used for artist and user metadata, None to disable"""
+
+
+release_source = None
+"""source of Artist.releases, eG resilience.ResilientClient, None for api"""
+
+
+def _release_fetch():
+    """
+    Get the function fetching all releases of an artist.
+
+    :return: list_all_releases_for_artist of release_source or the api module
+    """
+    source = api if release_source is None else release_source
+    return source.list_all_releases_for_artist
+
+
+def _metadata():
+    """
+    Get the source for artist and user metadata.
+
+    :return: metadata_cache if set, else the api module
+    """
+    return api if metadata_cache is None else metadata_cache
+
+
 class ApiUser(object):
     """
     User centric API.
@@ -34,10 +70,14 @@ class ApiUser(object):
     :ivar bool notify_remix: receive notifications for remix releases
     :ivar bool notify_other: receive notifications for other stuff
     :ivar bool notify_compilation: receive notification for compilations
+
+    Instances can be shared between threads, concurrent calls to update()
+    send each change only once and attributes changed while update() waits
+    for the server are kept and sent with the next update().
     """
     _fields = ('notify', 'notify_album', 'notify_single',
                'notify_ep', 'notify_live', 'notify_compilation',
-               'notify_remix', 'notify_other', 'notify_compilation')
+               'notify_remix', 'notify_other')
 
     @property
     def auth(self):
@@ -62,13 +102,41 @@ class ApiUser(object):
         self.email = email
         self.password = password
 
-        data = api.get_user(self.auth)
+        data = _metadata().get_user(self.auth)
         assert(self.email == data.email)  # this should never happen
         self.userid = data.userid
+        self._lock = threading.Lock()
+        self._apply(data)
+        self._artists = ArtistList(self.auth, self.userid)
 
+    def _apply(self, data, sent=None):
+        """
+        Take over user preferences as known to the server.
+
+        If sent is given, attributes that were changed locally since the
+        changes were sent keep their local value.
+
+        :param api.UserInfo data: user data as returned by the API
+        :param dict|None sent: changes sent to the server
+        """
         for key in self._fields:
+            if sent is not None:
+                expected = sent.get(key, getattr(self._info, key))
+                if getattr(self, key) != expected:
+                    continue
             setattr(self, key, getattr(data, key))
-        self._artists = ArtistList(self.auth, self.userid)
+        self._info = data
+
+    @property
+    def changes(self):
+        """
+        Preferences changed locally and not yet saved.
+
+        :return: changed attributes and their new values
+        :rtype: dict
+        """
+        return {k: getattr(self, k) for k in self._fields
+                if getattr(self, k) != getattr(self._info, k)}
 
     @property
     def artists(self):
@@ -93,6 +161,15 @@ class ApiUser(object):
             for release in artist.releases:
                 yield release
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']  # locks can't be pickled
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
     def __repr__(self):
         return "%s(email=%r, password='***')" % (self.__class__.__name__,
                                                  self.email)
@@ -137,13 +214,38 @@ class ApiUser(object):
         the data is not saved until update() is called. This is not needed
         for artist subscriptions, they are stored instantly.
 
+        Only attributes changed since the last load or save are sent, if
+        nothing changed no request is made at all. Changes made outside of
+        this instance in the meantime are not detected.
+
         :return: updated user data
         :rtype: api.UserInfo
         """
-        web_data = api.get_user(self.auth, self.userid)
-        data = {k: getattr(self, k) for k in self._fields
-                if getattr(self, k) != getattr(web_data, k)}
-        return api.update_user(self.auth, self.userid, **data)
+        with self._lock:
+            changes = self.changes
+            if changes:
+                self._apply(api.update_user(self.auth, self.userid,
+                                            **changes), changes)
+                if metadata_cache is not None:
+                    metadata_cache.discard_user(self.auth)
+            return self._info
+
+    @staticmethod
+    def update_many(users, max_workers=4):
+        """
+        Save preferences of many users.
+
+        Users without changes are skipped, the remaining updates are sent
+        concurrently.
+
+        :param list(ApiUser) users: users to save
+        :param int max_workers: number of concurrent requests
+        :return: updated user data in the order of users
+        :rtype: list(api.UserInfo)
+        :raises: HTTPError
+        """
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            return list(pool.map(ApiUser.update, users))
 
 
 class ArtistList(object):
@@ -152,6 +254,9 @@ class ArtistList(object):
 
     This behaves more or less like a list where adding and removing items
     subscribes or un-subscribes from the artist.
+
+    Instances can be shared between threads. Changes to the list are
+    serialized, iterating works on a snapshot of the list.
     """
     def __init__(self, auth, userid):
         """
@@ -164,42 +269,100 @@ class ArtistList(object):
         """
         self._auth = auth
         self._userid = userid
-        data = api.list_artist_subscriptions(self._auth, self._userid)
+        self._lock = threading.RLock()
+        data = _metadata().list_artist_subscriptions(self._auth,
+                                                     self._userid)
         self._data = [Artist.from_artist_info(a) for a in data]
 
+    def refresh(self):
+        """
+        Update the list with subscriptions changed elsewhere.
+
+        Fetches the subscription list and compares it to the current contents
+        by mbid. Artists still subscribed keep their Artist instance and
+        cached releases, only new artists are created.
+
+        :return: tuple of (added mbids, removed mbids)
+        :rtype: tuple(set, set)
+        """
+        with self._lock:
+            self._discard_cached()
+            data = _metadata().list_artist_subscriptions(self._auth,
+                                                         self._userid)
+            current = {a.mbid: a for a in self._data}
+            self._data = [current.get(a.mbid) or Artist.from_artist_info(a)
+                          for a in data]
+        mbids = set(a.mbid for a in data)
+        return mbids - set(current), set(current) - mbids
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']  # locks can't be pickled
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
     def __repr__(self):
         return "ArtistList(%r)" % self._data
 
     def __str__(self):
         return "ArtistList(%s)" % self._data
 
+    def _discard_cached(self):
+        """Drop the cached subscription list after changing it."""
+        if metadata_cache is not None:
+            metadata_cache.discard('subscriptions', self._auth, self._userid)
+
     @staticmethod
     def _artist(other):
         """
         Helper to get an Artist instance.
 
         Takes an Artist, api.ArtistInfo or string to create an Artist instance.
-        If a string is given, it is assumed to be a musicbrainz ID.
+        If a string is given, it is assumed to be a musicbrainz ID and its
+        syntax is checked before asking the server.
 
         :param other: source object
         :type other: Artist|api.ArtistInfo|str
         :return: artist instance
         :rtype: Artist
+        :raises: ValueError if other can't be interpreted
         """
-        if isinstance(other, api.ArtistInfo):
+        if isinstance(other, Artist):
+            return other
+        elif isinstance(other, api.ArtistInfo):
             return Artist.from_artist_info(other)
         elif isinstance(other, basestring):
-            return Artist.from_artist_info(api.get_artist(other))
+            if not api.is_valid_mbid(other):
+                raise ValueError("invalid mbid: %r" % other)
+            return Artist.from_mbid(other)
         else:
             raise ValueError("can't interpret %r" % other)
     
     def __iadd__(self, other):
         """Subscribe to a new artist. see add(other)."""
-        return self.add(other)
+        self.add(other)
+        return self
 
     def __isub__(self, other):
         """Un-subscribe from an artist. see remove(other)."""
-        return self.remove(other)
+        self.remove(other)
+        return self
+
+    def _index(self, mbid):
+        """
+        Find an artist in the list by mbid. Caller must hold the lock.
+
+        :param str mbid: artist musicbrainz ID
+        :return: position in the list or None
+        :rtype: int|None
+        """
+        for (index, artist) in enumerate(self._data):
+            if artist.mbid == mbid:
+                return index
+        return None
 
     def add(self, other):  # TODO: untested
         """
@@ -212,10 +375,12 @@ class ArtistList(object):
         :type other: Artist|api.ArtistInfo|str
         """
         other = self._artist(other)
-        if other in self._data:
-            raise ValueError("%r already in list" % other)
-        api.add_artist_subscription(self._auth, self._userid, other.mbid)
-        return self._data.append(other)
+        with self._lock:
+            if self._index(other.mbid) is not None:
+                raise ValueError("%r already in list" % other)
+            api.add_artist_subscription(self._auth, self._userid, other.mbid)
+            self._discard_cached()
+            self._data = self._data + [other]
 
     def remove(self, other):  # TODO: untested
         """
@@ -228,10 +393,14 @@ class ArtistList(object):
         :type other: Artist|api.ArtistInfo|str
         """
         other = self._artist(other)
-        if other not in self._data:
-            raise ValueError("%r not in list" % other)
-        api.remove_artist_subscription(self._auth, self._userid, other.mbid)
-        self._data.remove(other)
+        with self._lock:
+            index = self._index(other.mbid)
+            if index is None:
+                raise ValueError("%r not in list" % other)
+            api.remove_artist_subscription(self._auth, self._userid,
+                                           other.mbid)
+            self._discard_cached()
+            self._data = self._data[:index] + self._data[index + 1:]
 
     def __getitem__(self, item):
         return self._data.__getitem__(item)
@@ -241,7 +410,8 @@ class ArtistList(object):
 
     def __contains__(self, other):
         other = self._artist(other)
-        return other in self._data
+        with self._lock:
+            return self._index(other.mbid) is not None
 
     def __iter__(self):
         return iter(self._data)
@@ -261,7 +431,12 @@ class Artist(object):
     :ivar str disambiguation: a sort artist description if disambiguation 
                               is needed
     :ivar list releases: lazily loaded list of releases by this artist
+    :ivar cache.ReleaseCache|None release_cache: shared cache for releases,
+                                                 set on the class to use it
+                                                 for all artists
     """
+    release_cache = None
+
     def __init__(self, name, mbid, sort_name=None, disambiguation=""):
         """
         Constructor.
@@ -272,6 +447,7 @@ class Artist(object):
         :param str|None disambiguation: disambiguation description if needed
         """
         self._releases = None
+        self._lock = threading.Lock()
         self.name = name
         self.mbid = mbid
         self.sort_name = sort_name if sort_name is not None else name
@@ -298,7 +474,7 @@ class Artist(object):
         :return: Artist info
         :rtype: Artist
         """
-        data = api.get_artist(mbid)
+        data = _metadata().get_artist(mbid)
         return cls.from_artist_info(data)
 
     @property
@@ -311,13 +487,44 @@ class Artist(object):
         release types to notify for are used to filter the artist releases on
         the server side.
 
+        Releases are fetched through release_source if it is set.
+        If release_cache is set, releases are kept there instead of in the
+        instance and fetched again after they have been evicted.
+
+        If several threads read the releases at the same time, only one of
+        them fetches the list and the others wait for it.
+
         :return: list of artist releases
         :rtype: list(ReleaseInfo)
         """
+        if self.release_cache is not None:
+            return self.release_cache.get(self.mbid, _release_fetch())
         if self._releases is None:
-            self._releases = api.list_all_releases_for_artist(self.mbid)
+            with self._lock:
+                if self._releases is None:
+                    self._releases = _release_fetch()(self.mbid)
         return self._releases
 
+    def _prime_releases(self, releases):
+        """
+        Set releases fetched elsewhere.
+
+        :param list(ReleaseInfo) releases: releases of this artist
+        """
+        if self.release_cache is not None:
+            self.release_cache.put(self.mbid, releases)
+        else:
+            self._releases = releases
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']  # locks can't be pickled
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
     def __str__(self):
         return "<Artist %s>" % self.name
 
@@ -11,6 +11,7 @@ __version__ = '0.1.0'
 
 import requests
 import collections
+import re
 
 
 RELEASE_LIST_LIMIT = 100
@@ -22,6 +23,10 @@ LASTFM_IMPORT_LIMIT = 500
 API_BASE_URL = 'https://muspy.com/api/1'
 """base url for API calls"""
 
+MBID_PATTERN = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-'
+                          r'[0-9a-f]{12}\Z', re.IGNORECASE)
+"""syntax of musicbrainz IDs"""
+
 
 ArtistInfo = collections.namedtuple('ArtistInfo', ('name', 'mbid', 'sort_name',
                                                    'disambiguation'))
@@ -38,6 +43,45 @@ UserInfo = collections.namedtuple('UserInfo', ('userid', 'email', 'notify',
                                                'notify_remix', 'notify_other'))
 
 
+_session = None
+
+
+def set_session(session):
+    """
+    Use a session for all API requests.
+
+    A requests.Session keeps connections to the server open between calls.
+    Pass None to go back to one connection per request.
+
+    :param requests.Session|None session: session to use
+    """
+    global _session
+    _session = session
+
+
+def _client():
+    """
+    Get the object to send requests with.
+
+    :return: the session set with set_session or the requests module
+    """
+    return requests if _session is None else _session
+
+
+def is_valid_mbid(mbid):
+    """
+    Check the syntax of a musicbrainz ID without asking the server.
+
+    :param str mbid: musicbrainz ID
+    :return: True if mbid is a syntactically valid UUID
+    :rtype: bool
+    """
+    try:
+        return MBID_PATTERN.match(mbid) is not None
+    except TypeError:
+        return False
+
+
 def _release_from_json(json_response):
     """
     Convert release info from json format to ReleaseInfo.
@@ -66,7 +110,7 @@ def get_artist(mbid):
              HTTPError 404 if it is syntactically invalid
     """
     url = '%s/artist/%s' % (API_BASE_URL, mbid)
-    response = requests.get(url)
+    response = _client().get(url)
     response.raise_for_status()
     return ArtistInfo(**response.json())
 
@@ -84,7 +128,7 @@ def list_artist_subscriptions(auth, userid):
     :raises:
     """
     url = '%s/artists/%s' % (API_BASE_URL, userid)
-    response = requests.get(url, auth=auth)
+    response = _client().get(url, auth=auth)
     response.raise_for_status()
     return [ArtistInfo(**row) for row in response.json()]
 
@@ -100,7 +144,7 @@ def add_artist_subscription(auth, userid, artist_mbid):
     :raises: HTTPError
     """
     url = '%s/artists/%s/%s' % (API_BASE_URL, userid, artist_mbid)
-    response = requests.put(url, auth=auth)
+    response = _client().put(url, auth=auth)
     response.raise_for_status()
     return True
 
@@ -126,7 +170,7 @@ def import_lastfm_subscriptions(auth, userid, lastfm_username,
     if limit < 0 or limit > LASTFM_IMPORT_LIMIT:
         raise ValueError('invalid limit: %r' % limit)
 
-    response = requests.put(url, auth=auth,
+    response = _client().put(url, auth=auth,
                             data={'lastfm_username': lastfm_username,
                                   'count': limit, 'period': period})
     response.raise_for_status()
@@ -144,7 +188,7 @@ def remove_artist_subscription(auth, userid, artist_mbid):
     :raises: HTTPError
     """
     url = '%s/artists/%s/%s' % (API_BASE_URL, userid, artist_mbid)
-    response = requests.delete(url, auth=auth)
+    response = _client().delete(url, auth=auth)
     response.raise_for_status()
     return True
 
@@ -159,11 +203,11 @@ def get_release(release_mbid):
     :raises: HTTPError on errors
     """
     url = '%s/release/%s' % (API_BASE_URL, release_mbid)
-    response = requests.get(url)
+    response = _client().get(url)
     response.raise_for_status()
     json = response.json()
     json['artist'] = ArtistInfo(**json['artist'])
-    return ReleaseInfo(json)
+    return ReleaseInfo(**json)
 
 
 def list_all_releases_for_artist(artist_mbid, userid=None):
@@ -230,7 +274,7 @@ def list_releases(userid=None, artist_mbid=None, limit=None, offset=None,
     if since is not None:
         params['since'] = since
 
-    response = requests.get(url, params=params)
+    response = _client().get(url, params=params)
     response.raise_for_status()
     return [_release_from_json(row) for row in response.json()]
 
@@ -251,7 +295,7 @@ def get_user(auth, userid=None):
         url = '%s/user' % (API_BASE_URL,)
     else:
         url = '%s/user/%s' % (API_BASE_URL, userid)
-    response = requests.get(url, auth=auth)
+    response = _client().get(url, auth=auth)
     response.raise_for_status()
     return UserInfo(**response.json())
 
@@ -268,8 +312,9 @@ def create_user(email, password, send_activation=True):  # TODO: testing
     :raises: HTTPError
     """
     url = '%s/user' % (API_BASE_URL,)
-    response = requests.post(url, data={'email': email, 'password': password,
-                                        'activate': int(send_activation)})
+    response = _client().post(url, data={'email': email,
+                                         'password': password,
+                                         'activate': int(send_activation)})
     response.raise_for_status()
     return True
 
@@ -287,7 +332,7 @@ def delete_user(auth, userid):  # TODO: testing
     :raises: HTTPError
     """
     url = '%s/user/%s' % (API_BASE_URL, userid)
-    response = requests.delete(url, auth=auth)
+    response = _client().delete(url, auth=auth)
     response.raise_for_status()
     return True
 
@@ -327,6 +372,6 @@ def update_user(auth, userid, **kwargs):
             raise RuntimeError('invalid argument: %r' % key)
 
     url = '%s/user/%s' % (API_BASE_URL, userid)
-    response = requests.put(url, auth=auth, data=data)
+    response = _client().put(url, auth=auth, data=data)
     response.raise_for_status()
     return UserInfo(**response.json())
@@ -0,0 +1,344 @@
+"""
+Batch operations spanning many users and artists.
+
+When releases are scanned for many accounts the same artists show up in a lot
+of subscription lists. The helpers in this module fetch data per unique
+artist instead of per subscription and share the results between users.
+"""
+
+
+__author__ = 'David Poisl <david@poisl.at>'
+__version__ = '0.1.0'
+
+
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from . import api
+from . import Artist
+from . import _metadata
+from . import _release_fetch
+
+
+RELEASE_TYPES = ('album', 'single', 'ep', 'live', 'compilation', 'remix',
+                 'other')
+"""release types matching the notify_* user preferences"""
+
+TYPE_BITS = {name: 1 << bit for (bit, name) in enumerate(RELEASE_TYPES)}
+"""bit for each release type in a preference mask"""
+
+ALL_TYPES = (1 << len(RELEASE_TYPES)) - 1
+"""mask matching every release type"""
+
+INVALID = 'invalid'
+"""resolver error: the mbid is syntactically invalid"""
+
+NOT_FOUND = 'not found'
+"""resolver error: no artist with this mbid exists"""
+
+
+def type_code(release_type):
+    """
+    Get the bit for a release type.
+
+    Types not covered by a notify_* preference count as 'other'.
+
+    :param str|None release_type: release type, eG 'Album' or 'EP'
+    :return: bit of the release type
+    :rtype: int
+    """
+    return TYPE_BITS.get((release_type or '').lower(), TYPE_BITS['other'])
+
+
+def preference_mask(user):
+    """
+    Build a release type bitmask from a users notify_* preferences.
+
+    :param user: user preferences
+    :type user: api.UserInfo|ApiUser
+    :return: bitmask of wanted release types
+    :rtype: int
+    """
+    mask = 0
+    for name in RELEASE_TYPES:
+        if getattr(user, 'notify_' + name):
+            mask |= TYPE_BITS[name]
+    return mask
+
+
+def _mbid(artist):
+    """
+    Get the musicbrainz ID of an artist.
+
+    :param artist: the artist
+    :type artist: Artist|api.ArtistInfo|str
+    :return: musicbrainz ID
+    :rtype: str
+    """
+    if isinstance(artist, (Artist, api.ArtistInfo)):
+        return artist.mbid
+    return artist
+
+
+class ReleaseTypeFilter(object):
+    """
+    Filter one unfiltered release list for many users.
+
+    Type codes are computed once per release, each user preference is
+    reduced to a bitmask and users sharing the same mask share the filtered
+    result list. This gives the same result as the server side filter of
+    list_all_releases_for_artist(mbid, userid) with a single fetch.
+
+    :ivar list releases: unfiltered releases
+    :ivar list codes: type bit of each release
+    """
+    def __init__(self, releases):
+        """
+        Constructor.
+
+        :param list(ReleaseInfo) releases: unfiltered releases
+        """
+        if not isinstance(releases, list):
+            releases = list(releases)
+        self.releases = releases
+        self.codes = [type_code(r.type) for r in self.releases]
+        self._results = {ALL_TYPES: self.releases}
+
+    def filter(self, mask):
+        """
+        Get releases matching a preference mask.
+
+        Results are cached per mask.
+
+        :param int mask: bitmask of wanted release types
+        :return: matching releases
+        :rtype: list(ReleaseInfo)
+        """
+        try:
+            return self._results[mask]
+        except KeyError:
+            result = [r for (r, c) in zip(self.releases, self.codes)
+                      if c & mask]
+            self._results[mask] = result
+            return result
+
+    def filter_many(self, users):
+        """
+        Filter releases for many users in one pass per distinct mask.
+
+        :param dict users: user key to UserInfo, ApiUser or int mask
+        :return: user key to matching releases
+        :rtype: dict(object, list(ReleaseInfo))
+        """
+        return {key: self.filter(_as_mask(user))
+                for key, user in users.items()}
+
+
+def _as_mask(user):
+    """Get a preference mask from a mask or a user object."""
+    if isinstance(user, int):
+        return user
+    return preference_mask(user)
+
+
+def releases_for_users(artist_mbid, users):
+    """
+    Get an artists releases for many users with one fetch.
+
+    :param str artist_mbid: musicbrainz id of the artist
+    :param dict users: user key to UserInfo, ApiUser or int mask
+    :return: user key to releases matching the users preferences
+    :rtype: dict(object, list(ReleaseInfo))
+    :raises: HTTPError
+    """
+    releases = api.list_all_releases_for_artist(artist_mbid)
+    return ReleaseTypeFilter(releases).filter_many(users)
+
+
+class ReleasePlanner(object):
+    """
+    Fetch releases for many users with one request series per unique artist.
+
+    Subscription lists of all users are collected first, then each unique
+    artist's releases are fetched exactly once. Every user's result maps the
+    artist mbid to the very same release list object, so popular artists
+    are held in memory only once. Artist instances passed in get their
+    release cache primed with the shared list.
+
+    If preferences are given for a user, its releases are filtered on the
+    client side by release type (see ReleaseTypeFilter), in that case
+    Artist instances of that user are not primed.
+
+    Artists whose releases can't be fetched don't stop the plan, they are
+    left out of the results and recorded in errors.
+
+    :ivar dict errors: artist mbid to the error of its last fetch
+    """
+    def __init__(self):
+        """Constructor."""
+        self._subscriptions = {}
+        self._artists = {}
+        self._masks = {}
+        self.errors = {}
+
+    def add(self, user, artists, preferences=None):
+        """
+        Add the subscription list of a user.
+
+        :param user: any hashable key identifying the user
+        :param artists: subscribed artists
+        :type artists: iterable(Artist|api.ArtistInfo|str)
+        :param preferences: release type preferences to filter by
+        :type preferences: api.UserInfo|ApiUser|int|None
+        """
+        mbids = self._subscriptions.setdefault(user, [])
+        if preferences is not None:
+            self._masks[user] = _as_mask(preferences)
+        for artist in artists:
+            mbid = _mbid(artist)
+            mbids.append(mbid)
+            instances = self._artists.setdefault(mbid, [])
+            if isinstance(artist, Artist) and preferences is None:
+                instances.append(artist)
+
+    def add_user(self, user, filtered=False):
+        """
+        Add the subscriptions of an ApiUser, keyed by its user id.
+
+        :param ApiUser user: the user
+        :param bool filtered: filter releases by the users preferences
+        """
+        self.add(user.userid, user.artists, user if filtered else None)
+
+    @property
+    def mbids(self):
+        """
+        Unique artist mbids over all users.
+
+        :return: set of musicbrainz IDs
+        :rtype: set
+        """
+        return set(self._artists)
+
+    @property
+    def subscription_count(self):
+        """
+        Total number of subscriptions over all users.
+
+        :return: number of subscriptions
+        :rtype: int
+        """
+        return sum(len(m) for m in self._subscriptions.values())
+
+    def fetch(self, max_workers=4):
+        """
+        Fetch releases of every unique artist once.
+
+        Failed artists are recorded in errors instead of raising.
+
+        :param int max_workers: number of concurrent fetches
+        :return: releases by artist mbid for all artists fetched successfully
+        :rtype: dict(str, list(ReleaseInfo))
+        """
+        releases = {}
+        self.errors = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            fetch = _release_fetch()
+            futures = {mbid: pool.submit(fetch, mbid)
+                       for mbid in self._artists}
+            for mbid, future in futures.items():
+                try:
+                    releases[mbid] = future.result()
+                except requests.RequestException as error:
+                    self.errors[mbid] = error
+        for mbid, artists in self._artists.items():
+            if mbid in releases:
+                for artist in artists:
+                    artist._prime_releases(releases[mbid])
+        return releases
+
+    def execute(self, max_workers=4):
+        """
+        Fetch all releases and map them back to every user.
+
+        Artists that failed are missing from the user dicts, see errors.
+
+        :param int max_workers: number of concurrent fetches
+        :return: per user a dict of artist mbid to the shared release list
+        :rtype: dict(object, dict(str, list(ReleaseInfo)))
+        """
+        releases = self.fetch(max_workers)
+        filters = {}
+        result = {}
+        for user, mbids in self._subscriptions.items():
+            mbids = [mbid for mbid in mbids if mbid in releases]
+            mask = self._masks.get(user, ALL_TYPES)
+            if mask == ALL_TYPES:
+                result[user] = {mbid: releases[mbid] for mbid in mbids}
+                continue
+            for mbid in mbids:
+                if mbid not in filters:
+                    filters[mbid] = ReleaseTypeFilter(releases[mbid])
+            result[user] = {mbid: filters[mbid].filter(mask)
+                            for mbid in mbids}
+        return result
+
+
+def _resolve(source, mbid):
+    """
+    Fetch one artist for resolve_artists.
+
+    :return: tuple of (ArtistInfo or None, error or None)
+    """
+    try:
+        return source.get_artist(mbid), None
+    except requests.HTTPError as error:
+        status = getattr(error.response, 'status_code', None)
+        if status == 410:
+            return None, NOT_FOUND
+        if status == 404:
+            return None, INVALID
+        return None, error
+    except requests.RequestException as error:
+        return None, error
+
+
+def resolve_artists(mbids, max_workers=8, source=None):
+    """
+    Resolve many artist mbids.
+
+    The syntax of every mbid is checked locally, valid ones are lower-cased
+    and fetched once each, concurrently. Results and errors of valid mbids
+    are keyed by the lower-case spelling. Known artists are served from
+    muspy_client.metadata_cache if it is set.
+
+    The error map contains INVALID for malformed mbids, NOT_FOUND for
+    unknown artists and the exception for other failures.
+
+    :param iterable(str) mbids: artist mbids
+    :param int max_workers: number of concurrent requests
+    :param source: object providing get_artist(mbid), defaults to the
+                   metadata cache or the api module
+    :return: tuple of (dict mbid to ArtistInfo, dict mbid to error)
+    :rtype: tuple(dict, dict)
+    """
+    if source is None:
+        source = _metadata()
+    artists = {}
+    errors = {}
+    valid = set()
+    for mbid in mbids:
+        if api.is_valid_mbid(mbid):
+            valid.add(mbid.lower())
+        else:
+            errors[mbid] = INVALID
+    valid = list(valid)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        results = pool.map(lambda mbid: _resolve(source, mbid), valid)
+        for mbid, (artist, error) in zip(valid, results):
+            if error is None:
+                artists[mbid] = artist
+            else:
+                errors[mbid] = error
+    return artists, errors
@@ -0,0 +1,565 @@
+"""
+Caches for data fetched from the API.
+
+The ReleaseCache holds release lists of artists within a fixed budget of
+entries or (estimated) bytes, so long running processes keep a flat memory
+footprint no matter how many artists they touch.
+
+The StaleCache serves artist and user metadata without waiting for the
+server as long as slightly outdated data is acceptable.
+"""
+
+
+__author__ = 'David Poisl <david@poisl.at>'
+__version__ = '0.1.0'
+
+
+import collections
+import os
+import pickle
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from . import api
+
+
+LRU = 'lru'
+"""evict the least recently used entry"""
+
+LFU = 'lfu'
+"""evict the least frequently used entry"""
+
+
+def sizeof(releases):
+    """
+    Estimate the memory used by a list of releases.
+
+    Counts the list, the ReleaseInfo and ArtistInfo tuples and their string
+    values. Objects shared between releases are counted for each release.
+
+    :param list(ReleaseInfo) releases: releases to measure
+    :return: estimated size in bytes
+    :rtype: int
+    """
+    size = sys.getsizeof(releases)
+    for release in releases:
+        size += sys.getsizeof(release)
+        for value in release:
+            size += sys.getsizeof(value)
+            if isinstance(value, tuple):
+                size += sum(sys.getsizeof(v) for v in value)
+    return size
+
+
+class DirectoryStore(object):
+    """
+    Persistent dict-like store keeping one pickle file per key.
+
+    Writes are atomic (a temporary file is renamed into place), so several
+    processes can safely share one directory. Keys must be usable as file
+    names, which is the case for musicbrainz IDs; keys containing a path
+    separator or naming a directory are rejected with a KeyError so no file
+    outside the directory can be read or written.
+    """
+    def __init__(self, path):
+        """
+        Constructor.
+
+        :param str path: directory to store files in, created if missing
+        """
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _file(self, key):
+        """Get the file name for a key, KeyError if it is no plain name."""
+        if (key in ('', os.curdir, os.pardir) or
+                os.path.basename(key) != key):
+            raise KeyError(key)
+        return os.path.join(self.path, key + '.pickle')
+
+    def __getitem__(self, key):
+        try:
+            with open(self._file(key), 'rb') as data:
+                return pickle.load(data)
+        except (IOError, OSError, EOFError):
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        path = self._file(key)
+        handle, name = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(handle, 'wb') as data:
+            pickle.dump(value, data, pickle.HIGHEST_PROTOCOL)
+        os.rename(name, path)
+
+    def __delitem__(self, key):
+        path = self._file(key)
+        try:
+            os.remove(path)
+        except OSError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        try:
+            return os.path.exists(self._file(key))
+        except KeyError:
+            return False
+
+
+class ReleaseCache(object):
+    """
+    Bounded cache for release lists keyed by artist mbid.
+
+    Entries are evicted by LRU or LFU policy when max_entries or max_bytes
+    is exceeded and expire after ttl seconds. Evicted entries are written to
+    the optional store, a dict-like object such as a shelve, and loaded from
+    there before falling back to fetching them from the API again. The
+    store is only accessed while holding the cache lock, so it doesn't need
+    to be thread-safe itself.
+
+    :ivar int hits: number of lookups served from memory
+    :ivar int misses: number of lookups not served from memory
+    :ivar int evictions: number of entries evicted for the budget
+    """
+    def __init__(self, max_entries=None, max_bytes=None, ttl=None,
+                 policy=LRU, store=None, clock=time.time):
+        """
+        Constructor.
+
+        :param int|None max_entries: maximum number of cached artists
+        :param int|None max_bytes: maximum estimated size of cached releases
+        :param float|None ttl: seconds after which entries expire
+        :param str policy: LRU or LFU
+        :param store: persistent dict-like store for evicted entries
+        :param callable clock: time source returning seconds
+        """
+        if policy not in (LRU, LFU):
+            raise ValueError('invalid policy: %r' % policy)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.policy = policy
+        self.store = store
+        self._clock = clock
+        self._lock = threading.RLock()
+        self._entries = {}  # key -> [releases, stamp, size, frequency]
+        self._order = collections.OrderedDict()  # LRU order
+        self._buckets = {}  # LFU: frequency -> OrderedDict of keys
+        self._loading = {}  # key -> [event, releases, error]
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and not self._expired(entry[1])
+
+    def _expired(self, stamp):
+        """Check if an entry stored at stamp is expired."""
+        return self.ttl is not None and self._clock() - stamp > self.ttl
+
+    def _link(self, key, entry):
+        """Add an entry to the eviction order. Caller must hold the lock."""
+        if self.policy == LRU:
+            self._order[key] = None
+            return
+        frequency = entry[3]
+        self._buckets.setdefault(frequency,
+                                 collections.OrderedDict())[key] = None
+
+    def _touch(self, key, entry):
+        """Record an access to an entry. Caller must hold the lock."""
+        if self.policy == LRU:
+            del self._order[key]
+            self._order[key] = None
+            return
+        frequency = entry[3]
+        bucket = self._buckets[frequency]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[frequency]
+        entry[3] = frequency + 1
+        self._link(key, entry)
+
+    def _unlink(self, key):
+        """Remove an entry from memory. Caller must hold the lock."""
+        entry = self._entries.pop(key)
+        self.size -= entry[2]
+        if self.policy == LRU:
+            del self._order[key]
+        else:
+            bucket = self._buckets[entry[3]]
+            del bucket[key]
+            if not bucket:
+                del self._buckets[entry[3]]
+        return entry
+
+    def _victim(self, keep):
+        """
+        Get the key to evict next. Caller must hold the lock.
+
+        :param str keep: key that must not be evicted
+        :return: key or None if there is no other entry
+        """
+        if self.policy == LRU:
+            keys = iter(self._order)
+        else:
+            keys = (key for frequency in sorted(self._buckets)
+                    for key in self._buckets[frequency])
+        for key in keys:
+            if key != keep:
+                return key
+        return None
+
+    def _over_budget(self):
+        """Check if the cache exceeds its budget."""
+        return ((self.max_entries is not None and
+                 len(self._entries) > self.max_entries) or
+                (self.max_bytes is not None and self.size > self.max_bytes))
+
+    def _evict(self, keep):
+        """
+        Evict entries until the budget is met. Caller must hold the lock.
+
+        The entry just stored is never evicted, otherwise a new key would
+        be dropped right away under LFU as long as older entries were used
+        more often.
+
+        :param str keep: key that must not be evicted
+        """
+        while self._over_budget():
+            key = self._victim(keep)
+            if key is None:
+                return
+            releases, stamp = self._unlink(key)[:2]
+            self.evictions += 1
+            if self.store is not None:
+                self.store[key] = (stamp, releases)
+
+    def put(self, key, releases, stamp=None):
+        """
+        Store the releases of an artist.
+
+        Replacing an entry keeps its access count.
+
+        :param str key: artist mbid
+        :param list(ReleaseInfo) releases: releases of the artist
+        :param float|None stamp: time the releases were fetched
+        """
+        entry = [releases, self._clock() if stamp is None else stamp,
+                 sizeof(releases) if self.max_bytes is not None else 0, 1]
+        with self._lock:
+            if key in self._entries:
+                entry[3] = self._unlink(key)[3] + 1
+            self._entries[key] = entry
+            self.size += entry[2]
+            self._link(key, entry)
+            self._evict(key)
+
+    def _load(self, key):
+        """
+        Load an entry from the store. Caller must hold the lock.
+
+        :return: releases or None if missing or expired
+        :rtype: list(ReleaseInfo)|None
+        """
+        if self.store is None:
+            return None
+        try:
+            stamp, releases = self.store[key]
+        except KeyError:
+            return None
+        if self._expired(stamp):
+            return None
+        self.put(key, releases, stamp)
+        return releases
+
+    def get(self, key, fetch=None):
+        """
+        Get the releases of an artist.
+
+        Served from memory, the store or fetched from the API in that order.
+        Concurrent lookups of the same missing key wait for one fetch.
+
+        :param str key: artist mbid
+        :param callable|None fetch: called with the key on a miss, defaults
+                                    to api.list_all_releases_for_artist
+        :return: releases of the artist
+        :rtype: list(ReleaseInfo)
+        :raises: HTTPError
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not self._expired(entry[1]):
+                self.hits += 1
+                self._touch(key, entry)
+                return entry[0]
+            self.misses += 1
+            loading = self._loading.get(key)
+            if loading is None:
+                loading = self._loading[key] = [threading.Event(), None,
+                                                None]
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            loading[0].wait()
+            if loading[2] is not None:
+                raise loading[2]
+            return loading[1]
+        try:
+            with self._lock:
+                releases = self._load(key)
+            if releases is None:
+                if fetch is None:
+                    fetch = api.list_all_releases_for_artist
+                releases = fetch(key)
+                self.put(key, releases)
+            loading[1] = releases
+            return releases
+        except Exception as error:
+            loading[2] = error
+            raise
+        finally:
+            with self._lock:
+                del self._loading[key]
+            loading[0].set()
+
+    def discard(self, key):
+        """
+        Remove an artist from memory and the store.
+
+        :param str key: artist mbid
+        """
+        with self._lock:
+            if key in self._entries:
+                self._unlink(key)
+            if self.store is not None and key in self.store:
+                del self.store[key]
+
+    def clear(self):
+        """Remove all entries from memory."""
+        with self._lock:
+            self._entries.clear()
+            self._order.clear()
+            self._buckets.clear()
+            self.size = 0
+
+
+class StaleCache(object):
+    """
+    Stale-while-revalidate cache for artist and user metadata.
+
+    Entries younger than ttl are served directly. Expired entries younger
+    than ttl + max_stale are served immediately as well while a small pool
+    of background threads refreshes them; if too many refreshes are already
+    queued the stale entry is served without one. Older entries are fetched
+    synchronously; if that fails, entries younger than ttl + stale_if_error
+    are served instead of raising the error.
+
+    Fetches that are still running when their entry is discarded don't
+    store their result, so data from before a change is never cached after
+    it. After close() stale entries are served without a refresh.
+
+    The get_artist, get_user and list_artist_subscriptions methods take the
+    same arguments as their counterparts in the api module, so an instance
+    can be used in place of it.
+    """
+    def __init__(self, ttl=300.0, max_stale=3600.0, stale_if_error=86400.0,
+                 max_entries=None, refresh_workers=2, max_refreshes=32,
+                 clock=time.time):
+        """
+        Constructor.
+
+        :param float ttl: seconds an entry is fresh
+        :param float max_stale: seconds after expiry an entry is served while
+                                it is refreshed in the background
+        :param float stale_if_error: seconds after expiry an entry is served
+                                     if fetching a new one fails
+        :param int|None max_entries: maximum number of entries (LRU)
+        :param int refresh_workers: threads refreshing stale entries
+        :param int max_refreshes: maximum number of queued refreshes
+        :param callable clock: time source returning seconds
+        """
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.stale_if_error = stale_if_error
+        self.max_entries = max_entries
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # key -> (stamp, value)
+        self._refreshing = set()
+        self._loading = collections.Counter()  # key -> running fetches
+        self._generations = {}  # key -> discards while fetches are running
+        self._pool = ThreadPoolExecutor(max_workers=refresh_workers)
+        self._closed = False
+        self.max_refreshes = max_refreshes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _store(self, key, value):
+        """Store a fresh value. Caller must hold the lock."""
+        self._entries.pop(key, None)
+        self._entries[key] = (self._clock(), value)
+        while (self.max_entries is not None and
+               len(self._entries) > self.max_entries):
+            self._entries.popitem(last=False)
+
+    def _begin(self, key):
+        """
+        Register a running fetch. Caller must hold the lock.
+
+        :return: generation of the key, see _finish
+        :rtype: int
+        """
+        self._loading[key] += 1
+        return self._generations.get(key, 0)
+
+    def _finish(self, key, generation):
+        """
+        Unregister a running fetch. Caller must hold the lock.
+
+        :param int generation: generation returned by _begin
+        :return: True if the key was not discarded since _begin
+        :rtype: bool
+        """
+        current = self._generations.get(key, 0) == generation
+        self._loading[key] -= 1
+        if not self._loading[key]:
+            del self._loading[key]
+            self._generations.pop(key, None)
+        return current
+
+    def _remove(self, key):
+        """Remove an entry and outdate fetches. Caller must hold the lock."""
+        self._entries.pop(key, None)
+        if key in self._loading:
+            self._generations[key] = self._generations.get(key, 0) + 1
+
+    def _refresh(self, key, generation, fetch, args):
+        """Fetch a value in the background, keeping the old one on errors."""
+        try:
+            value = fetch(*args)
+        except Exception:
+            with self._lock:
+                self._refreshing.discard(key)
+                self._finish(key, generation)
+            return
+        with self._lock:
+            self._refreshing.discard(key)
+            if self._finish(key, generation):
+                self._store(key, value)
+
+    def get(self, key, fetch, *args):
+        """
+        Get a value.
+
+        :param tuple key: cache key
+        :param callable fetch: called with args to get a new value
+        :return: cached or fetched value
+        :raises: errors of fetch if no stale value can be served
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                stamp, value = entry
+                age = self._clock() - stamp
+                if age <= self.ttl:
+                    self._entries.pop(key)
+                    self._entries[key] = entry
+                    return value
+                if age <= self.ttl + self.max_stale:
+                    if (not self._closed and
+                            key not in self._refreshing and
+                            len(self._refreshing) < self.max_refreshes):
+                        self._refreshing.add(key)
+                        self._pool.submit(self._refresh, key,
+                                          self._begin(key), fetch, args)
+                    return value
+            generation = self._begin(key)
+        try:
+            value = fetch(*args)
+        except Exception as error:
+            with self._lock:
+                self._finish(key, generation)
+            if (isinstance(error, requests.RequestException) and
+                    entry is not None and
+                    age <= self.ttl + self.stale_if_error):
+                return entry[1]
+            raise
+        with self._lock:
+            if self._finish(key, generation):
+                self._store(key, value)
+        return value
+
+    def close(self):
+        """
+        Stop the refresh threads after queued refreshes are done.
+
+        Stale entries are served without a refresh afterwards.
+        """
+        with self._lock:
+            self._closed = True
+        self._pool.shutdown(wait=False)
+
+    def discard(self, *key):
+        """
+        Remove an entry.
+
+        :param key: cache key, eG ('artist', mbid)
+        """
+        with self._lock:
+            self._remove(key)
+
+    def discard_user(self, auth):
+        """
+        Remove all entries fetched with the authentication of a user.
+
+        :param tuple auth: authentication data (email, password)
+        """
+        with self._lock:
+            for key in [k for k in set(self._entries) | set(self._loading)
+                        if len(k) > 1 and k[1] == auth]:
+                self._remove(key)
+
+    def get_artist(self, mbid):
+        """
+        Get information about an artist. see api.get_artist.
+
+        :param str mbid: musicbrainz id of the artist
+        :rtype: api.ArtistInfo
+        """
+        return self.get(('artist', mbid), api.get_artist, mbid)
+
+    def get_user(self, auth, userid=None):
+        """
+        Get info for a user. see api.get_user.
+
+        :param tuple auth: (username, password)
+        :param str|None userid: user to query
+        :rtype: api.UserInfo
+        """
+        return self.get(('user', auth, userid), api.get_user, auth, userid)
+
+    def list_artist_subscriptions(self, auth, userid):
+        """
+        List all artists a user subscribed to. see
+        api.list_artist_subscriptions.
+
+        :param tuple auth: (username, password)
+        :param str userid: user id (must match auth data)
+        :rtype: list(api.ArtistInfo)
+        """
+        return self.get(('subscriptions', auth, userid),
+                        api.list_artist_subscriptions, auth, userid)
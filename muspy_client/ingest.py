@@ -0,0 +1,212 @@
+"""
+Resumable ingestion of the global release feed.
+
+The ReleaseIngester mirrors list_releases(userid=None) into a sink such as a
+database. Pages are fetched by a background thread with a bounded read-ahead
+while the previous batch is written, and after every batch the position is
+saved to a checkpoint. A restarted ingester continues with the first batch
+that was not written. Once the feed has been read completely, the newest
+release becomes the since watermark and later runs only fetch what is new.
+
+Pages are requested by offset, so releases published during a run can shift
+a page and be delivered twice. Sinks should therefore store releases by
+mbid (upsert) instead of blindly appending them.
+"""
+
+
+__author__ = 'David Poisl <david@poisl.at>'
+__version__ = '0.1.0'
+
+
+import json
+import os
+import tempfile
+import threading
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+from . import api
+
+
+class FileCheckpoint(object):
+    """
+    Checkpoint stored as JSON file.
+
+    The file is replaced atomically, so a crash while saving leaves the
+    previous checkpoint intact.
+    """
+    def __init__(self, path):
+        """
+        Constructor.
+
+        :param str path: checkpoint file
+        """
+        self.path = path
+
+    def load(self):
+        """
+        Load the checkpoint.
+
+        :return: saved state or an empty dict if there is none
+        :rtype: dict
+        """
+        try:
+            with open(self.path) as data:
+                return json.load(data)
+        except (IOError, OSError):
+            return {}
+
+    def save(self, state):
+        """
+        Save the checkpoint.
+
+        :param dict state: state to save
+        """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        handle, name = tempfile.mkstemp(dir=directory)
+        with os.fdopen(handle, 'w') as data:
+            json.dump(state, data)
+            data.flush()
+            os.fsync(data.fileno())
+        os.rename(name, self.path)
+
+
+class MemoryCheckpoint(object):
+    """Checkpoint kept in memory, eG for tests or one-off runs."""
+    def __init__(self, state=None):
+        """
+        Constructor.
+
+        :param dict|None state: initial state
+        """
+        self.state = dict(state or {})
+
+    def load(self):
+        """
+        Load the checkpoint.
+
+        :rtype: dict
+        """
+        return dict(self.state)
+
+    def save(self, state):
+        """
+        Save the checkpoint.
+
+        :param dict state: state to save
+        """
+        self.state = dict(state)
+
+
+class ReleaseIngester(object):
+    """
+    Copy the global release feed into a sink with checkpointing.
+
+    The sink is either a callable or an object with a write() method, it is
+    called with a list of releases and must have stored them durably when it
+    returns. The checkpoint is an object with load() and save(state) methods
+    like FileCheckpoint.
+
+    The saved state contains:
+
+      * since: mbid of the newest release of the last complete run
+      * offset: releases of the current run already written
+      * head: mbid of the newest release of the current run
+    """
+    def __init__(self, sink, checkpoint, batch_size=500, read_ahead=4,
+                 fetch=None):
+        """
+        Constructor.
+
+        :param sink: callable or object with write(releases)
+        :param checkpoint: object with load() and save(state)
+        :param int batch_size: releases written to the sink at once
+        :param int read_ahead: pages fetched ahead of the sink
+        :param callable|None fetch: replacement for api.list_releases
+        """
+        if batch_size < 1 or read_ahead < 1:
+            raise ValueError('invalid batch size or read ahead: %r, %r' %
+                             (batch_size, read_ahead))
+        self._write = sink.write if hasattr(sink, 'write') else sink
+        self.checkpoint = checkpoint
+        self.batch_size = batch_size
+        self.read_ahead = read_ahead
+        self._fetch = fetch
+
+    def _pages(self, since, offset, pages, stop):
+        """
+        Fetch pages into a queue until the feed ends or stop is set.
+
+        Puts lists of releases, an exception on errors and None at the end.
+        """
+        fetch = self._fetch if self._fetch is not None else api.list_releases
+        try:
+            while not stop.is_set():
+                part = fetch(since=since, limit=api.RELEASE_LIST_LIMIT,
+                             offset=offset)
+                offset += len(part)
+                self._put(pages, part, stop)
+                if len(part) < api.RELEASE_LIST_LIMIT:
+                    break
+        except Exception as error:
+            self._put(pages, error, stop)
+        self._put(pages, None, stop)
+
+    @staticmethod
+    def _put(pages, item, stop):
+        """Put an item into the queue unless stop is set."""
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def run(self):
+        """
+        Ingest releases until the end of the feed.
+
+        :return: number of releases written to the sink
+        :rtype: int
+        :raises: HTTPError or errors of the sink; the checkpoint holds the
+                 position of the last written batch
+        """
+        state = self.checkpoint.load()
+        since = state.get('since')
+        offset = state.get('offset', 0)
+        head = state.get('head')
+        pages = queue.Queue(maxsize=self.read_ahead)
+        stop = threading.Event()
+        fetcher = threading.Thread(target=self._pages,
+                                   args=(since, offset, pages, stop))
+        fetcher.daemon = True
+        fetcher.start()
+        written = 0
+        batch = []
+        try:
+            while True:
+                page = pages.get()
+                if isinstance(page, Exception):
+                    raise page
+                if page:
+                    if head is None:
+                        head = page[0].mbid
+                    batch += page
+                if batch and (page is None or
+                              len(batch) >= self.batch_size):
+                    self._write(batch)
+                    offset += len(batch)
+                    written += len(batch)
+                    batch = []
+                    self.checkpoint.save({'since': since, 'offset': offset,
+                                          'head': head})
+                if page is None:
+                    break
+        finally:
+            stop.set()
+        self.checkpoint.save({'since': head or since, 'offset': 0,
+                              'head': None})
+        return written
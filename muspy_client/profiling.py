@@ -0,0 +1,234 @@
+"""
+Phase level profiling of API calls.
+
+While a Profiler is active every API call is split into phases which are
+timed separately per endpoint:
+
+  * network: sending the request and receiving the response
+  * decode: decoding the JSON body
+  * construct: building ReleaseInfo objects in api._release_from_json
+  * wrap: creating Artist instances in Artist.from_artist_info
+
+Optionally memory allocated in each phase is tracked with tracemalloc. The
+results are available as a text report and as collapsed stacks which can be
+fed to flamegraph.pl or speedscope.
+"""
+
+
+__author__ = 'David Poisl <david@poisl.at>'
+__version__ = '0.1.0'
+
+
+import threading
+import time
+import tracemalloc
+
+from . import api
+from . import Artist
+
+
+NETWORK = 'network'
+"""phase: waiting for the server"""
+
+DECODE = 'decode'
+"""phase: decoding JSON"""
+
+CONSTRUCT = 'construct'
+"""phase: building ReleaseInfo objects"""
+
+WRAP = 'wrap'
+"""phase: building Artist objects"""
+
+PHASES = (NETWORK, DECODE, CONSTRUCT, WRAP)
+
+
+def _endpoint(method, url):
+    """
+    Get an endpoint name from a request.
+
+    :param str method: HTTP method
+    :param str url: request url
+    :return: endpoint name, eG 'GET releases'
+    :rtype: str
+    """
+    path = url
+    if path.startswith(api.API_BASE_URL):
+        path = path[len(api.API_BASE_URL):]
+    return '%s %s' % (method.upper(), path.strip('/').split('/')[0])
+
+
+class _Response(object):
+    """Response proxy timing the decode phase of json()."""
+    def __init__(self, profiler, endpoint, response):
+        self._profiler = profiler
+        self._endpoint = endpoint
+        self._response = response
+
+    def json(self, **kwargs):
+        return self._profiler.measure(self._endpoint, DECODE,
+                                      self._response.json, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+
+class _Session(object):
+    """Session proxy timing the network phase of requests."""
+    def __init__(self, profiler, client):
+        self._profiler = profiler
+        self._client = client
+
+    def _request(self, method, url, **kwargs):
+        endpoint = _endpoint(method, url)
+        self._profiler._local.endpoint = endpoint
+        response = self._profiler.measure(endpoint, NETWORK,
+                                          getattr(self._client, method),
+                                          url, **kwargs)
+        return _Response(self._profiler, endpoint, response)
+
+    def get(self, url, **kwargs):
+        return self._request('get', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self._request('put', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self._request('post', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self._request('delete', url, **kwargs)
+
+
+class Profiler(object):
+    """
+    Context manager collecting phase timings of API calls.
+
+    Only one profiler may be active at a time. Usage::
+
+        with Profiler() as profiler:
+            releases = list(user.releases)
+        print(profiler.report())
+
+    :ivar dict stats: (endpoint, phase) to [calls, seconds, bytes]
+    """
+    def __init__(self, trace_memory=True, root='muspy_client'):
+        """
+        Constructor.
+
+        :param bool trace_memory: track allocations with tracemalloc
+        :param str root: name of the root frame in collapsed stacks
+        """
+        self.trace_memory = trace_memory
+        self.root = root
+        self.stats = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._saved = None
+
+    def _current(self):
+        """Get the endpoint of the last request in this thread."""
+        return getattr(self._local, 'endpoint', 'unknown')
+
+    def measure(self, endpoint, phase, function, *args, **kwargs):
+        """
+        Call a function and account its time to an endpoint and phase.
+
+        :param str endpoint: endpoint name
+        :param str phase: phase name
+        :param callable function: function to call
+        :return: result of the function
+        """
+        memory = self.trace_memory and tracemalloc.is_tracing()
+        before = tracemalloc.get_traced_memory()[0] if memory else 0
+        start = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            allocated = (tracemalloc.get_traced_memory()[0] - before
+                         if memory else 0)
+            with self._lock:
+                entry = self.stats.setdefault((endpoint, phase), [0, 0.0, 0])
+                entry[0] += 1
+                entry[1] += elapsed
+                entry[2] += max(allocated, 0)
+
+    def start(self):
+        """Install the profiling hooks."""
+        if self._saved is not None:
+            raise RuntimeError('profiler already started')
+        release_from_json = api._release_from_json
+        from_artist_info = Artist.__dict__['from_artist_info']
+        self._saved = (api._session, release_from_json, from_artist_info,
+                       self.trace_memory and not tracemalloc.is_tracing())
+        if self._saved[3]:
+            tracemalloc.start()
+
+        def construct(json_response):
+            return self.measure(self._current(), CONSTRUCT,
+                                release_from_json, json_response)
+
+        def wrap(cls, artist_info):
+            return self.measure(self._current(), WRAP,
+                                from_artist_info.__func__, cls, artist_info)
+
+        api.set_session(_Session(self, api._client()))
+        api._release_from_json = construct
+        Artist.from_artist_info = classmethod(wrap)
+
+    def stop(self):
+        """Remove the profiling hooks."""
+        if self._saved is None:
+            return
+        session, release_from_json, from_artist_info, tracing = self._saved
+        api.set_session(session)
+        api._release_from_json = release_from_json
+        Artist.from_artist_info = from_artist_info
+        if tracing:
+            tracemalloc.stop()
+        self._saved = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def report(self):
+        """
+        Format the collected timings as a table.
+
+        Rows are sorted by time spent, slowest first.
+
+        :return: report text
+        :rtype: str
+        """
+        with self._lock:
+            rows = sorted(self.stats.items(), key=lambda i: -i[1][1])
+        total = sum(row[1][1] for row in rows) or 1.0
+        lines = ['%-20s %-10s %8s %10s %6s %12s' % ('endpoint', 'phase',
+                                                   'calls', 'seconds', '%',
+                                                   'bytes')]
+        for (endpoint, phase), (calls, seconds, allocated) in rows:
+            lines.append('%-20s %-10s %8d %10.3f %6.1f %12d' % (
+                endpoint, phase, calls, seconds, 100 * seconds / total,
+                allocated))
+        return '\n'.join(lines)
+
+    def collapsed(self):
+        """
+        Format the collected timings as collapsed stacks.
+
+        One line per endpoint and phase in the form
+        "root;endpoint;phase microseconds", the input format of
+        flamegraph.pl.
+
+        :return: collapsed stacks
+        :rtype: str
+        """
+        with self._lock:
+            items = sorted(self.stats.items())
+        return '\n'.join('%s;%s;%s %d' % (self.root, endpoint, phase,
+                                          round(seconds * 1e6))
+                         for (endpoint, phase), (_, seconds, _) in items)
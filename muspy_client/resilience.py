@@ -0,0 +1,362 @@
+"""
+Tail latency control for idempotent API calls.
+
+The ResilientClient wraps the read-only calls of the api module. Requests
+that take longer than the recent 95th percentile of their endpoint are sent a
+second time and whichever copy answers first wins. A circuit breaker per
+endpoint fails fast while the server is degraded instead of piling up slow
+requests.
+"""
+
+
+__author__ = 'David Poisl <david@poisl.at>'
+__version__ = '0.1.0'
+
+
+import collections
+import threading
+import time
+from concurrent.futures import (ThreadPoolExecutor, wait, FIRST_COMPLETED,
+                                TimeoutError)
+
+import requests
+
+from . import api
+
+
+CLOSED = 'closed'
+"""circuit breaker state: requests pass"""
+
+OPEN = 'open'
+"""circuit breaker state: requests fail fast"""
+
+HALF_OPEN = 'half-open'
+"""circuit breaker state: one trial request passes"""
+
+
+class CircuitOpenError(requests.RequestException):
+    """Raised instead of sending a request while a circuit is open."""
+
+
+def _is_failure(error):
+    """
+    Check if an error indicates a degraded server.
+
+    Client errors like 404 or 410 are valid answers and don't count.
+
+    :param Exception error: the error
+    :rtype: bool
+    """
+    if isinstance(error, requests.HTTPError):
+        response = getattr(error, 'response', None)
+        return response is None or response.status_code >= 500
+    return isinstance(error, requests.RequestException)
+
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker for one endpoint.
+
+    After failure_threshold consecutive failures the circuit opens and calls
+    fail with CircuitOpenError. After reset_timeout seconds one trial call is
+    let through, its outcome closes or opens the circuit again.
+
+    :ivar str state: CLOSED, OPEN or HALF_OPEN
+    :ivar int failures: consecutive failures
+    :ivar int rejected: calls rejected while open
+    """
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0,
+                 listener=None, clock=time.time):
+        """
+        Constructor.
+
+        :param str name: endpoint name
+        :param int failure_threshold: failures until the circuit opens
+        :param float reset_timeout: seconds until a trial call is allowed
+        :param callable|None listener: called as listener(name, old, new)
+                                       on state changes
+        :param callable clock: time source returning seconds
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.listener = listener
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._opened = 0.0
+        self.state = CLOSED
+        self.failures = 0
+        self.rejected = 0
+
+    def _set_state(self, state):
+        """Change the state and notify the listener. Caller holds the lock."""
+        old, self.state = self.state, state
+        if old != state and self.listener is not None:
+            self.listener(self.name, old, state)
+
+    def before(self):
+        """
+        Check if a call may be made.
+
+        :raises: CircuitOpenError if the circuit is open
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            if (self.state == OPEN and
+                    self._clock() - self._opened >= self.reset_timeout):
+                self._set_state(HALF_OPEN)
+                return
+            self.rejected += 1
+            raise CircuitOpenError('circuit for %s is %s' % (self.name,
+                                                             self.state))
+
+    def success(self):
+        """Record a successful call."""
+        with self._lock:
+            self.failures = 0
+            self._set_state(CLOSED)
+
+    def failure(self):
+        """Record a failed call."""
+        with self._lock:
+            self.failures += 1
+            if (self.state == HALF_OPEN or
+                    self.failures >= self.failure_threshold):
+                self._opened = self._clock()
+                self._set_state(OPEN)
+
+    def call(self, function, *args, **kwargs):
+        """
+        Call a function through the breaker.
+
+        :param callable function: function to call
+        :return: result of the function
+        :raises: CircuitOpenError or errors of the function
+        """
+        self.before()
+        try:
+            result = function(*args, **kwargs)
+        except Exception as error:
+            if _is_failure(error):
+                self.failure()
+            else:
+                self.success()
+            raise
+        self.success()
+        return result
+
+
+class LatencyTracker(object):
+    """
+    Sliding window of response times for one endpoint.
+
+    :ivar int calls: requests sent through the client
+    :ivar int hedged: requests that were sent a second time
+    :ivar int hedge_wins: hedged requests where the second copy won
+    """
+    def __init__(self, window=200):
+        """
+        Constructor.
+
+        :param int window: number of recent response times kept
+        """
+        self._samples = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add(self, seconds):
+        """
+        Record a response time.
+
+        :param float seconds: response time
+        """
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, fraction=0.95):
+        """
+        Get a percentile of the recorded response times.
+
+        :param float fraction: percentile as fraction, eG 0.95
+        :return: response time or None without samples
+        :rtype: float|None
+        """
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+class ResilientClient(object):
+    """
+    Hedging and circuit breaking wrapper for read-only API calls.
+
+    get_artist, get_release and list_releases take the same arguments as
+    in the api module. Hedging starts once min_samples response times of an
+    endpoint are known. The hedging delay counts from the moment a request
+    actually starts, not from when it was queued for a thread, and at most
+    max_hedge_ratio of all requests of an endpoint are hedged so a
+    saturated client doesn't double its own load.
+
+    An instance can be set as muspy_client.release_source to be used for
+    Artist.releases.
+    """
+    def __init__(self, hedge=True, max_workers=8, min_samples=20,
+                 min_delay=0.05, window=200, failure_threshold=5,
+                 reset_timeout=30.0, listener=None, max_hedge_ratio=0.1):
+        """
+        Constructor.
+
+        :param bool hedge: send hedged requests
+        :param int max_workers: threads available for requests
+        :param int min_samples: response times needed before hedging
+        :param float min_delay: minimum seconds to wait before hedging
+        :param int window: response times kept per endpoint
+        :param int failure_threshold: failures until a circuit opens
+        :param float reset_timeout: seconds until a trial call is allowed
+        :param callable|None listener: called as listener(endpoint, old,
+                                       new) on circuit state changes
+        :param float max_hedge_ratio: maximum fraction of hedged requests
+        """
+        self.hedge = hedge
+        self.max_hedge_ratio = max_hedge_ratio
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        self._latency = {}
+        self._breakers = {}
+        for name in ('get_artist', 'get_release', 'list_releases'):
+            self._latency[name] = LatencyTracker(window)
+            self._breakers[name] = CircuitBreaker(name, failure_threshold,
+                                                  reset_timeout, listener)
+
+    def _timed(self, name, function, args, kwargs, started=None):
+        """
+        Call a function and record its response time.
+
+        :param list|None started: [event, start time], the event is set
+                                  when the call starts
+        """
+        start = time.time()
+        if started is not None:
+            started[1] = start
+            started[0].set()
+        result = function(*args, **kwargs)
+        self._latency[name].add(time.time() - start)
+        return result
+
+    def _hedged(self, name, function, args, kwargs):
+        """
+        Call a function, sending a second copy if it is slow.
+
+        :return: result of whichever call succeeds first
+        """
+        tracker = self._latency[name]
+        tracker.calls += 1
+        started = [threading.Event(), None]
+        first = self._pool.submit(self._timed, name, function, args, kwargs,
+                                  started)
+        if not self.hedge or len(tracker) < self.min_samples:
+            return first.result()
+        delay = max(self.min_delay, tracker.percentile())
+        started[0].wait()
+        try:
+            return first.result(timeout=max(0.0, started[1] + delay -
+                                            time.time()))
+        except TimeoutError:
+            pass
+        if tracker.hedged >= self.max_hedge_ratio * tracker.calls:
+            return first.result()
+        tracker.hedged += 1
+        second = self._pool.submit(self._timed, name, function, args, kwargs)
+        pending = set((first, second))
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is second:
+                        tracker.hedge_wins += 1
+                    return future.result()
+            if not pending:
+                return done.pop().result()
+
+    def _call(self, name, *args, **kwargs):
+        """Call an api function through its circuit breaker."""
+        function = getattr(api, name)
+        return self._breakers[name].call(self._hedged, name, function, args,
+                                         kwargs)
+
+    def get_artist(self, mbid):
+        """
+        Get information about an artist. see api.get_artist.
+
+        :rtype: api.ArtistInfo
+        """
+        return self._call('get_artist', mbid)
+
+    def get_release(self, release_mbid):
+        """
+        Get information about a release. see api.get_release.
+
+        :rtype: api.ReleaseInfo
+        """
+        return self._call('get_release', release_mbid)
+
+    def list_releases(self, userid=None, artist_mbid=None, limit=None,
+                      offset=None, since=None):
+        """
+        Get releases for an artist (or all releases). see api.list_releases.
+
+        :rtype: list(api.ReleaseInfo)
+        """
+        return self._call('list_releases', userid=userid,
+                          artist_mbid=artist_mbid, limit=limit,
+                          offset=offset, since=since)
+
+    def list_all_releases_for_artist(self, artist_mbid, userid=None):
+        """
+        Get all releases for a given artist.
+        see api.list_all_releases_for_artist.
+
+        :rtype: list(api.ReleaseInfo)
+        """
+        result = []
+        while True:
+            part = self.list_releases(userid=userid, artist_mbid=artist_mbid,
+                                      limit=api.RELEASE_LIST_LIMIT,
+                                      offset=len(result))
+            result += part
+            if len(part) < api.RELEASE_LIST_LIMIT:
+                return result
+
+    def metrics(self):
+        """
+        Get the current state of all endpoints.
+
+        :return: per endpoint a dict with circuit state, consecutive
+                 failures, rejected calls, p95 response time, number of
+                 requests, hedged requests and how often the hedge won
+        :rtype: dict(str, dict)
+        """
+        result = {}
+        for name, breaker in self._breakers.items():
+            tracker = self._latency[name]
+            result[name] = {'state': breaker.state,
+                            'failures': breaker.failures,
+                            'rejected': breaker.rejected,
+                            'p95': tracker.percentile(),
+                            'calls': tracker.calls,
+                            'hedged': tracker.hedged,
+                            'hedge_wins': tracker.hedge_wins}
+        return result
+
+    def close(self):
+        """Shut down the request threads."""
+        self._pool.shutdown(wait=False)
@@ -0,0 +1,404 @@
+"""
+Release watch scheduler.
+
+Polls list_releases for many users and artists from one long-running
+process. Every watched user or artist has its own poll interval which adapts
+to how often new releases were seen recently, polls are spread with random
+jitter and all requests share one global requests-per-second budget.
+
+New releases are handed to a callback or put into a queue.
+"""
+
+
+__author__ = 'David Poisl <david@poisl.at>'
+__version__ = '0.1.0'
+
+
+import heapq
+import itertools
+import random
+import threading
+import time
+
+from . import api
+
+
+USER = 'user'
+"""watch kind for users (releases filtered by the users preferences)"""
+
+ARTIST = 'artist'
+"""watch kind for single artists"""
+
+
+class RateLimiter(object):
+    """
+    Token bucket limiting the number of requests per second.
+
+    :ivar float rate: tokens added per second
+    :ivar float burst: maximum number of tokens stored
+    """
+    def __init__(self, rate, burst=1.0, clock=time.time):
+        """
+        Constructor.
+
+        :param float rate: allowed requests per second
+        :param float burst: maximum number of requests allowed at once
+        :param callable clock: time source returning seconds
+        """
+        if rate <= 0:
+            raise ValueError('invalid rate: %r' % rate)
+        self.rate = float(rate)
+        self.burst = float(max(burst, 1.0))
+        self._clock = clock
+        self._tokens = self.burst
+        self._stamp = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Try to take one token.
+
+        :return: 0 if a token was taken, else seconds until one is available
+        :rtype: float
+        """
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                return 0.0
+            return (1.0 - self._tokens) / self.rate
+
+    def acquire(self, sleep=time.sleep):
+        """
+        Block until a token is available and take it.
+
+        :param callable sleep: function used for waiting
+        """
+        while True:
+            delay = self.reserve()
+            if not delay:
+                return
+            sleep(delay)
+
+
+class Watch(object):
+    """
+    State of one watched user or artist.
+
+    :ivar str kind: USER or ARTIST
+    :ivar str ident: user id or artist mbid
+    :ivar str|None since: mbid of the newest release seen so far
+    :ivar float activity: moving average of polls that found new releases
+    :ivar float next_poll: timestamp of the next scheduled poll
+    :ivar int failures: consecutive failed polls
+    :ivar bool primed: the watch has a starting point for new releases
+    """
+    __slots__ = ('kind', 'ident', 'since', 'activity', 'next_poll',
+                 'failures', 'primed')
+
+    def __init__(self, kind, ident, since=None, activity=0.5):
+        self.kind = kind
+        self.ident = ident
+        self.since = since
+        self.activity = activity
+        self.next_poll = 0.0
+        self.failures = 0
+        self.primed = since is not None
+
+    @property
+    def key(self):
+        """
+        Unique key of this watch.
+
+        :return: tuple of (kind, ident)
+        :rtype: tuple
+        """
+        return self.kind, self.ident
+
+    def __repr__(self):
+        return '%s(%r, %r, since=%r)' % (self.__class__.__name__, self.kind,
+                                         self.ident, self.since)
+
+
+class ReleaseScheduler(object):
+    """
+    Priority queue based poller for new releases.
+
+    Watches are kept in a heap ordered by their next poll time. After each
+    poll the interval of a watch is recalculated from its activity, a moving
+    average of how many recent polls returned new releases: active watches
+    approach min_interval, quiet ones drift towards max_interval.
+
+    New releases are delivered as (kind, ident, releases) to the sink, which
+    can either be a callable or an object with a put() method such as a
+    Queue.
+
+    The first successful poll of a watch without a since value only records
+    the newest release as a starting point unless deliver_initial is set.
+    Releases found by later polls are always delivered, even if the first
+    poll found none.
+    """
+    def __init__(self, sink, rate=1.0, min_interval=3600.0,
+                 max_interval=7 * 86400.0, jitter=0.1, decay=0.8,
+                 deliver_initial=False, on_error=None, clock=time.time,
+                 sleep=time.sleep):
+        """
+        Constructor.
+
+        :param sink: callable or queue receiving (kind, ident, releases)
+        :param float rate: global budget of requests per second
+        :param float min_interval: shortest poll interval in seconds
+        :param float max_interval: longest poll interval in seconds
+        :param float jitter: relative random deviation of poll intervals
+        :param float decay: weight of the history in the activity average
+        :param bool deliver_initial: deliver releases of the first poll
+        :param callable|None on_error: called as on_error(watch, exception)
+                                       for failed polls and sink errors
+        :param callable clock: time source returning seconds
+        :param callable sleep: function used to wait for the rate limit
+        """
+        if min_interval <= 0 or max_interval < min_interval:
+            raise ValueError('invalid intervals: %r, %r' % (min_interval,
+                                                            max_interval))
+        if not 0 <= jitter < 1:
+            raise ValueError('invalid jitter: %r' % jitter)
+        self._deliver = sink.put if hasattr(sink, 'put') else sink
+        self.limiter = RateLimiter(rate, clock=clock)
+        self.min_interval = float(min_interval)
+        self.max_interval = float(max_interval)
+        self.jitter = jitter
+        self.decay = decay
+        self.deliver_initial = deliver_initial
+        self.on_error = on_error
+        self._clock = clock
+        self._sleep = sleep
+        self._watches = {}
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition(threading.Lock())
+        self._stopped = False
+
+    def __len__(self):
+        return len(self._watches)
+
+    def __contains__(self, key):
+        return key in self._watches
+
+    def watch_user(self, userid, since=None):
+        """
+        Watch new releases for a user.
+
+        The users release type preferences are applied by the server.
+
+        :param str userid: user id
+        :param str|None since: mbid of the last known release
+        :return: the watch
+        :rtype: Watch
+        """
+        return self._add(Watch(USER, userid, since))
+
+    def watch_artist(self, artist_mbid, since=None):
+        """
+        Watch new releases for an artist.
+
+        :param str artist_mbid: musicbrainz id of the artist
+        :param str|None since: mbid of the last known release
+        :return: the watch
+        :rtype: Watch
+        """
+        return self._add(Watch(ARTIST, artist_mbid, since))
+
+    def unwatch(self, kind, ident):
+        """
+        Stop watching a user or artist.
+
+        :param str kind: USER or ARTIST
+        :param str ident: user id or artist mbid
+        :return: the removed watch
+        :rtype: Watch
+        :raises: KeyError if the user or artist is not watched
+        """
+        with self._cond:
+            return self._watches.pop((kind, ident))
+
+    def _add(self, watch):
+        """
+        Register a watch and schedule its first poll.
+
+        First polls are spread randomly over min_interval to avoid a burst
+        of requests when many watches are added at once.
+        """
+        with self._cond:
+            if watch.key in self._watches:
+                raise ValueError('%r already watched' % (watch.key,))
+            self._watches[watch.key] = watch
+            self._schedule(watch, self._clock() +
+                           random.uniform(0, self.min_interval))
+            self._cond.notify()
+        return watch
+
+    def _schedule(self, watch, when):
+        """Push a watch onto the heap. Caller must hold the lock."""
+        watch.next_poll = when
+        heapq.heappush(self._heap, (when, next(self._counter), watch))
+
+    def interval(self, watch):
+        """
+        Calculate the next poll interval for a watch.
+
+        Interpolates geometrically between max_interval (activity 0) and
+        min_interval (activity 1). Failed polls back off exponentially.
+
+        :param Watch watch: the watch
+        :return: seconds until the next poll, without jitter
+        :rtype: float
+        """
+        value = (self.min_interval ** watch.activity *
+                 self.max_interval ** (1 - watch.activity))
+        if watch.failures:
+            value = min(self.max_interval,
+                        value * 2 ** min(watch.failures, 16))
+        return value
+
+    def _pop_due(self, now):
+        """
+        Pop the next due watch. Caller must hold the lock.
+
+        :return: tuple of (watch or None, seconds to wait if none is due)
+        :rtype: tuple
+        """
+        while self._heap:
+            when, _, watch = self._heap[0]
+            if (self._watches.get(watch.key) is not watch or
+                    watch.next_poll != when):
+                heapq.heappop(self._heap)  # unwatched or rescheduled
+                continue
+            if when > now:
+                return None, when - now
+            heapq.heappop(self._heap)
+            return watch, 0.0
+        return None, None
+
+    def _fetch(self, watch):
+        """
+        Fetch all releases newer than watch.since.
+
+        The first request is already charged to the rate limit by the
+        caller, every further page takes its own token.
+
+        :param Watch watch: the watch to poll
+        :return: new releases, newest first
+        :rtype: list(ReleaseInfo)
+        """
+        if watch.kind == USER:
+            kwargs = {'userid': watch.ident}
+        else:
+            kwargs = {'artist_mbid': watch.ident}
+        if not watch.primed:
+            return api.list_releases(limit=api.RELEASE_LIST_LIMIT, **kwargs)
+        result = []
+        while True:
+            if result:
+                self.limiter.acquire(self._sleep)
+            part = api.list_releases(since=watch.since,
+                                     limit=api.RELEASE_LIST_LIMIT,
+                                     offset=len(result), **kwargs)
+            result += part
+            if len(part) < api.RELEASE_LIST_LIMIT:
+                return result
+
+    def poll(self, watch):
+        """
+        Poll one watch, deliver new releases and update its activity.
+
+        watch.since only advances after the releases have been delivered, so
+        releases are fetched again if the sink fails.
+
+        :param Watch watch: the watch to poll
+        :return: new releases
+        :rtype: list(ReleaseInfo)
+        :raises: HTTPError or other requests exceptions, errors of the sink
+        """
+        initial = not watch.primed
+        releases = self._fetch(watch)
+        if initial and not self.deliver_initial:
+            if releases:
+                watch.since = releases[0].mbid
+            watch.primed = True
+            return []
+        if releases:
+            self._deliver((watch.kind, watch.ident, releases))
+            watch.since = releases[0].mbid
+        watch.primed = True
+        found = 1.0 if releases else 0.0
+        watch.activity = (self.decay * watch.activity +
+                          (1 - self.decay) * found)
+        return releases
+
+    def run_pending(self):
+        """
+        Poll all watches that are due, respecting the rate limit.
+
+        Does not block on the rate limit: if the budget is exhausted the
+        remaining due watches are left for the next call.
+
+        :return: seconds until the next watch is due or None if there is none
+        :rtype: float|None
+        """
+        while True:
+            with self._cond:
+                watch, wait = self._pop_due(self._clock())
+                if watch is None:
+                    return wait
+                delay = self.limiter.reserve()
+                if delay:
+                    self._schedule(watch, watch.next_poll)
+                    return delay
+            self._run_one(watch)
+
+    def _run_one(self, watch):
+        """
+        Poll a single watch and reschedule it.
+
+        Any error of the poll or the sink is counted as a failure and passed
+        to on_error, the watch is rescheduled in every case.
+        """
+        try:
+            self.poll(watch)
+            watch.failures = 0
+        except Exception as error:
+            watch.failures += 1
+            if self.on_error is not None:
+                self.on_error(watch, error)
+        finally:
+            interval = self.interval(watch)
+            interval *= random.uniform(1 - self.jitter, 1 + self.jitter)
+            with self._cond:
+                if self._watches.get(watch.key) is watch:
+                    self._schedule(watch, self._clock() + interval)
+
+    def run(self):
+        """
+        Poll watches until stop() is called.
+
+        Blocks the calling thread; run it in a dedicated thread if needed.
+        """
+        with self._cond:
+            self._stopped = False
+        while True:
+            wait = self.run_pending()
+            with self._cond:
+                if self._stopped:
+                    return
+                self._cond.wait(wait)
+                if self._stopped:
+                    return
+
+    def stop(self):
+        """Stop a running run() loop."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
@@ -0,0 +1,256 @@
+"""
+Multi-process release scans.
+
+Decoding responses and building ReleaseInfo objects is CPU bound, so a
+single process scanning many artists keeps only one core busy. The
+ShardedRunner splits artist mbids into shards and scans them in a process
+pool. Every worker has its own pooled requests.Session, all workers share a
+persistent cache directory and results are sent back to the parent as plain
+tuples.
+
+This module needs Python 3.7 or newer, it relies on the initializer of
+ProcessPoolExecutor and on BrokenProcessPool.
+"""
+
+
+__author__ = 'David Poisl <david@poisl.at>'
+__version__ = '0.1.0'
+
+
+import collections
+import sys
+import time
+
+if sys.version_info < (3, 7):
+    raise ImportError('muspy_client.sharding requires python 3.7 or newer')
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+import requests
+
+from . import api
+from . import cache
+
+
+INVALID = 'invalid mbid'
+"""failure description of malformed mbids, they are never fetched"""
+
+_store = None
+_ttl = None
+
+
+def _init_worker(cache_path, ttl):
+    """
+    Set up a worker process.
+
+    :param str|None cache_path: directory of the shared release cache
+    :param float|None ttl: seconds after which cached releases expire
+    """
+    global _store, _ttl
+    api.set_session(requests.Session())
+    _store = cache.DirectoryStore(cache_path) if cache_path else None
+    _ttl = ttl
+
+
+def pack(releases):
+    """
+    Convert releases to a compact form for sending between processes.
+
+    Each artist is stored once, releases reference it by index.
+
+    :param list(ReleaseInfo) releases: releases to pack
+    :return: tuple of (artist tuples, release tuples)
+    :rtype: tuple
+    """
+    artists = []
+    index = {}
+    rows = []
+    for release in releases:
+        position = index.get(release.artist)
+        if position is None:
+            position = index[release.artist] = len(artists)
+            artists.append(tuple(release.artist))
+        rows.append((release.name, release.mbid, release.date, release.type,
+                     position))
+    return tuple(artists), rows
+
+
+def unpack(packed):
+    """
+    Convert releases packed with pack() back to ReleaseInfo instances.
+
+    :param tuple packed: packed releases
+    :return: releases
+    :rtype: list(ReleaseInfo)
+    """
+    artists, rows = packed
+    artists = [api.ArtistInfo(*a) for a in artists]
+    return [api.ReleaseInfo(name, mbid, date, type_, artists[position])
+            for (name, mbid, date, type_, position) in rows]
+
+
+def _load(mbid):
+    """
+    Load releases from the shared cache.
+
+    :return: releases or None if missing or expired
+    :rtype: list(ReleaseInfo)|None
+    """
+    if _store is None:
+        return None
+    try:
+        stamp, releases = _store[mbid]
+    except KeyError:
+        return None
+    if _ttl is not None and time.time() - stamp > _ttl:
+        return None
+    return releases
+
+
+def _describe(error):
+    """
+    Get a picklable description of an error.
+
+    :param Exception error: the error
+    :return: error type and message
+    :rtype: str
+    """
+    return '%s: %s' % (error.__class__.__name__, error)
+
+
+def _scan(mbids):
+    """
+    Fetch the releases of one shard of artists in a worker process.
+
+    Errors are caught per artist, so one failing artist doesn't affect the
+    others in the shard.
+
+    :param list(str) mbids: artist mbids
+    :return: list of (mbid, packed releases or None, error or None)
+    :rtype: list(tuple)
+    """
+    result = []
+    for mbid in mbids:
+        try:
+            releases = _load(mbid)
+            if releases is None:
+                releases = api.list_all_releases_for_artist(mbid)
+                if _store is not None:
+                    _store[mbid] = (time.time(), releases)
+        except Exception as error:
+            result.append((mbid, None, _describe(error)))
+        else:
+            result.append((mbid, pack(releases), None))
+    return result
+
+
+class ShardedRunner(object):
+    """
+    Scan releases of many artists in a process pool.
+
+    Artists that fail are retried up to retries times, regrouped into new
+    shards. If a worker process dies the pool is restarted and the artists
+    of all unfinished shards are submitted again. Artists that still fail
+    are recorded in failed, as are malformed mbids (as INVALID) which are
+    not fetched at all.
+
+    The cache directory uses the same format as a DirectoryStore passed to
+    cache.ReleaseCache, so both can share it.
+
+    :ivar dict failed: mbid to a description of the last error for artists
+                       that failed
+    """
+    def __init__(self, processes=None, shard_size=50, cache_path=None,
+                 ttl=None, retries=2):
+        """
+        Constructor.
+
+        :param int|None processes: worker processes, defaults to CPU count
+        :param int shard_size: artists per shard
+        :param str|None cache_path: directory of the shared release cache
+        :param float|None ttl: seconds after which cached releases expire
+        :param int retries: how often a failed artist is retried
+        """
+        if shard_size < 1:
+            raise ValueError('invalid shard size: %r' % shard_size)
+        self.processes = processes
+        self.shard_size = shard_size
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.retries = retries
+        self.failed = {}
+
+    def shards(self, mbids):
+        """
+        Split artist mbids into shards, dropping duplicates.
+
+        :param iterable(str) mbids: artist mbids
+        :return: shards
+        :rtype: list(list(str))
+        """
+        unique = list(collections.OrderedDict.fromkeys(mbids))
+        return [unique[i:i + self.shard_size]
+                for i in range(0, len(unique), self.shard_size)]
+
+    def _failure(self, retry, attempts, mbid, error):
+        """Count a failed attempt and give up on the artist if needed."""
+        attempts[mbid] += 1
+        if attempts[mbid] > self.retries:
+            self.failed[mbid] = error
+        else:
+            retry.append(mbid)
+
+    def run(self, mbids, packed=False):
+        """
+        Fetch the releases of all artists.
+
+        Results are yielded as soon as a shard is done, in no particular
+        order.
+
+        :param iterable(str) mbids: artist mbids
+        :param bool packed: yield packed releases (see pack()) instead of
+                            ReleaseInfo lists to save work in this process
+        :return: generator of (mbid, releases)
+        :rtype: generator
+        """
+        self.failed = {}
+        valid = []
+        for mbid in mbids:
+            if api.is_valid_mbid(mbid):
+                valid.append(mbid)
+            else:
+                self.failed[mbid] = INVALID
+        shards = self.shards(valid)
+        attempts = collections.Counter()
+        while shards:
+            retry = []
+            with ProcessPoolExecutor(self.processes,
+                                     initializer=_init_worker,
+                                     initargs=(self.cache_path,
+                                               self.ttl)) as pool:
+                futures = {pool.submit(_scan, shard): shard
+                           for shard in shards}
+                try:
+                    for future in as_completed(list(futures)):
+                        try:
+                            result = future.result()
+                        except BrokenProcessPool:
+                            raise
+                        except Exception as error:
+                            result = [(mbid, None, _describe(error))
+                                      for mbid in futures[future]]
+                        del futures[future]
+                        for (mbid, releases, error) in result:
+                            if error is not None:
+                                self._failure(retry, attempts, mbid, error)
+                                continue
+                            if not packed:
+                                releases = unpack(releases)
+                            yield mbid, releases
+                except BrokenProcessPool as error:
+                    for shard in futures.values():
+                        for mbid in shard:
+                            self._failure(retry, attempts, mbid,
+                                          _describe(error))
+            shards = self.shards(retry)
@@ -0,0 +1,28 @@
+"""
+Tests for the low level api helpers.
+"""
+
+
+__author__ = 'David Poisl <david@poisl.at>'
+__version__ = '0.1.0'
+
+
+import pytest
+
+pytest.importorskip('requests')
+
+from muspy_client import api
+
+
+MBID = 'b10bbbfc-cf9e-42e0-be17-e2c3e1d2600d'
+
+
+@pytest.mark.parametrize('mbid', [MBID, MBID.upper()])
+def test_valid_mbid(mbid):
+    assert api.is_valid_mbid(mbid)
+
+
+@pytest.mark.parametrize('mbid', [MBID + '\n', ' ' + MBID, MBID[:-1],
+                                  MBID.replace('-', ''), '', None])
+def test_invalid_mbid(mbid):
+    assert not api.is_valid_mbid(mbid)
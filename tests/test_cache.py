@@ -0,0 +1,68 @@
+"""
+Tests for the metadata and release caches.
+"""
+
+
+__author__ = 'David Poisl <david@poisl.at>'
+__version__ = '0.1.0'
+
+
+import threading
+
+import pytest
+
+pytest.importorskip('requests')
+
+from muspy_client import cache
+
+
+class Clock(object):
+    """Manually advanced time source."""
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_discard_during_refresh_drops_result():
+    clock = Clock()
+    stale = cache.StaleCache(ttl=10, max_stale=100, clock=clock)
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow(value):
+        started.set()
+        release.wait(5)
+        return value
+
+    assert stale.get(('artist', 'a'), lambda: 'old') == 'old'
+    clock.now = 20
+    assert stale.get(('artist', 'a'), slow, 'outdated') == 'old'
+    assert started.wait(5)
+    stale.discard('artist', 'a')
+    release.set()
+    stale._pool.shutdown(wait=True)
+    assert stale.get(('artist', 'a'), lambda: 'new') == 'new'
+
+
+def test_discard_during_fetch_drops_result():
+    stale = cache.StaleCache()
+
+    def fetch():
+        stale.discard_user(('user', 'secret'))
+        return 'outdated'
+
+    key = ('user', ('user', 'secret'), None)
+    assert stale.get(key, fetch) == 'outdated'
+    assert len(stale) == 0
+    assert stale.get(key, lambda: 'new') == 'new'
+
+
+def test_closed_cache_serves_stale():
+    clock = Clock()
+    stale = cache.StaleCache(ttl=10, max_stale=100, clock=clock)
+    assert stale.get(('artist', 'a'), lambda: 'old') == 'old'
+    stale.close()
+    clock.now = 20
+    assert stale.get(('artist', 'a'), lambda: 'new') == 'old'
@@ -0,0 +1,76 @@
+"""
+Tests for the release watch scheduler.
+
+The api module is replaced by in-memory stubs, no requests are sent.
+"""
+
+
+__author__ = 'David Poisl <david@poisl.at>'
+__version__ = '0.1.0'
+
+
+import pytest
+
+pytest.importorskip('requests')
+
+from muspy_client import api, scheduler
+
+
+def _release(mbid):
+    return api.ReleaseInfo('release', mbid, '2015-01-01', 'Album', None)
+
+
+@pytest.fixture
+def feed(monkeypatch):
+    """Stub list_releases with a list of releases, newest first."""
+    releases = []
+
+    def list_releases(userid=None, artist_mbid=None, limit=None, offset=None,
+                      since=None):
+        result = releases
+        if since is not None:
+            result = result[:[r.mbid for r in result].index(since)]
+        offset = offset or 0
+        return result[offset:offset + limit]
+
+    monkeypatch.setattr(api, 'list_releases', list_releases)
+    return releases
+
+
+def test_first_poll_sets_starting_point(feed):
+    delivered = []
+    runner = scheduler.ReleaseScheduler(delivered.append)
+    watch = runner.watch_artist('artist')
+    feed.insert(0, _release('r1'))
+    assert runner.poll(watch) == []
+    assert watch.since == 'r1'
+    feed.insert(0, _release('r2'))
+    assert runner.poll(watch) == [feed[0]]
+    assert delivered == [(scheduler.ARTIST, 'artist', [feed[0]])]
+
+
+def test_empty_first_poll_delivers_later_releases(feed):
+    delivered = []
+    runner = scheduler.ReleaseScheduler(delivered.append)
+    watch = runner.watch_user('user')
+    assert runner.poll(watch) == []
+    assert watch.primed and watch.since is None
+    activity = watch.activity
+    feed.insert(0, _release('r1'))
+    assert runner.poll(watch) == [feed[0]]
+    assert delivered == [(scheduler.USER, 'user', [feed[0]])]
+    assert watch.since == 'r1'
+    assert watch.activity > activity
+
+
+def test_failed_first_poll_is_not_primed(feed, monkeypatch):
+    runner = scheduler.ReleaseScheduler(lambda item: None)
+    watch = runner.watch_artist('artist')
+
+    def fail(**kwargs):
+        raise ValueError('boom')
+
+    monkeypatch.setattr(api, 'list_releases', fail)
+    with pytest.raises(ValueError):
+        runner.poll(watch)
+    assert not watch.primed
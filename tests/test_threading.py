@@ -0,0 +1,197 @@
+"""
+Stress tests for sharing OOP objects between threads.
+
+The api module is replaced by in-memory stubs, no requests are sent.
+"""
+
+
+__author__ = 'David Poisl <david@poisl.at>'
+__version__ = '0.1.0'
+
+
+import pickle
+import threading
+import time
+import uuid
+
+import pytest
+
+pytest.importorskip('requests')
+
+import muspy_client
+from muspy_client import api, cache
+
+
+THREADS = 32
+
+
+def _run(target, count=THREADS):
+    """Start count threads on target at the same time and wait for them."""
+    barrier = threading.Barrier(count)
+    errors = []
+
+    def worker(number):
+        barrier.wait()
+        try:
+            target(number)
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=worker, args=(n,))
+               for n in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+@pytest.fixture
+def fetches(monkeypatch):
+    """Count calls of a slow list_all_releases_for_artist stub."""
+    calls = []
+    lock = threading.Lock()
+
+    def fetch(mbid, userid=None):
+        with lock:
+            calls.append(mbid)
+        time.sleep(0.05)
+        return [api.ReleaseInfo('release', mbid, '2015-01-01', 'Album',
+                                None)]
+
+    monkeypatch.setattr(api, 'list_all_releases_for_artist', fetch)
+    monkeypatch.setattr(muspy_client, 'release_source', None)
+    monkeypatch.setattr(muspy_client.Artist, 'release_cache', None)
+    return calls
+
+
+@pytest.fixture
+def server(monkeypatch):
+    """Stub the subscription endpoints with a set of subscribed mbids."""
+    subscribed = set()
+    lock = threading.Lock()
+
+    def add(auth, userid, mbid):
+        time.sleep(0.001)
+        with lock:
+            assert mbid not in subscribed
+            subscribed.add(mbid)
+        return True
+
+    def remove(auth, userid, mbid):
+        time.sleep(0.001)
+        with lock:
+            subscribed.remove(mbid)
+        return True
+
+    monkeypatch.setattr(api, 'list_artist_subscriptions',
+                        lambda auth, userid: [])
+    monkeypatch.setattr(api, 'add_artist_subscription', add)
+    monkeypatch.setattr(api, 'remove_artist_subscription', remove)
+    monkeypatch.setattr(api, 'get_artist',
+                        lambda mbid: api.ArtistInfo('artist', mbid,
+                                                    'artist', ''))
+    monkeypatch.setattr(muspy_client, 'metadata_cache', None)
+    return subscribed
+
+
+def test_artist_releases_fetched_once(fetches):
+    artist = muspy_client.Artist('artist', str(uuid.uuid4()))
+    results = []
+    assert not _run(lambda n: results.append(artist.releases))
+    assert fetches == [artist.mbid]
+    assert all(r is results[0] for r in results)
+
+
+def test_release_cache_fetched_once(fetches, monkeypatch):
+    monkeypatch.setattr(muspy_client.Artist, 'release_cache',
+                        cache.ReleaseCache(max_entries=100))
+    artists = [muspy_client.Artist('artist', str(uuid.uuid4()))
+               for _ in range(4)]
+    assert not _run(lambda n: [a.releases for a in artists])
+    assert sorted(fetches) == sorted(a.mbid for a in artists)
+
+
+def test_artist_list_no_lost_updates(server):
+    artists = muspy_client.ArtistList(('user', 'secret'), 'userid')
+    mbids = [str(uuid.uuid4()) for _ in range(THREADS * 8)]
+
+    def work(number):
+        mine = mbids[number::THREADS]
+        for mbid in mine:
+            artists.add(mbid)
+        for mbid in mine[::2]:
+            artists.remove(mbid)
+
+    assert not _run(work)
+    expected = set(mbids) - set(m for n in range(THREADS)
+                                for m in mbids[n::THREADS][::2])
+    assert set(a.mbid for a in artists) == expected
+    assert server == expected
+    assert len(artists) == len(expected)
+
+
+def test_artist_list_concurrent_duplicate_add(server):
+    artists = muspy_client.ArtistList(('user', 'secret'), 'userid')
+    mbid = str(uuid.uuid4())
+    errors = _run(lambda n: artists.add(mbid))
+    assert len(errors) == THREADS - 1
+    assert all(isinstance(e, ValueError) for e in errors)
+    assert [a.mbid for a in artists] == [mbid]
+    assert server == set([mbid])
+
+
+def test_api_user_keeps_changes_made_during_update(monkeypatch):
+    fields = dict.fromkeys(muspy_client.ApiUser._fields, True)
+    server = [api.UserInfo(userid='userid', email='user', **fields)]
+    sending = threading.Event()
+    release = threading.Event()
+    sent = []
+
+    def update_user(auth, userid, **kwargs):
+        sent.append(kwargs)
+        sending.set()
+        release.wait(5)
+        server[0] = server[0]._replace(**kwargs)
+        return server[0]
+
+    monkeypatch.setattr(muspy_client, 'metadata_cache', None)
+    monkeypatch.setattr(api, 'get_user', lambda auth, userid=None: server[0])
+    monkeypatch.setattr(api, 'list_artist_subscriptions',
+                        lambda auth, userid: [])
+    monkeypatch.setattr(api, 'update_user', update_user)
+    user = muspy_client.ApiUser('user', 'secret')
+    user.notify_album = False
+    thread = threading.Thread(target=user.update)
+    thread.start()
+    assert sending.wait(5)
+    user.notify_ep = False
+    release.set()
+    thread.join()
+    assert sent == [{'notify_album': False}]
+    assert not user.notify_album and not user.notify_ep
+    assert user.changes == {'notify_ep': False}
+    user.update()
+    assert sent[1] == {'notify_ep': False}
+    assert user.changes == {}
+    assert not server[0].notify_album and not server[0].notify_ep
+
+
+
+def test_pickle(server, monkeypatch):
+    info = api.UserInfo(userid='userid', email='user',
+                        **dict.fromkeys(muspy_client.ApiUser._fields, True))
+    monkeypatch.setattr(api, 'get_user', lambda auth, userid=None: info)
+    monkeypatch.setattr(api, 'update_user',
+                        lambda auth, userid, **kwargs: info._replace(**kwargs))
+    user = muspy_client.ApiUser('user', 'secret')
+    artist = muspy_client.Artist('artist', str(uuid.uuid4()))
+    user.artists.add(artist)
+    copy = pickle.loads(pickle.dumps(user))
+    assert [a.mbid for a in copy.artists] == [artist.mbid]
+    assert copy.changes == {}
+    copy.notify_ep = False
+    assert copy.update().notify_ep is False
+    copy.artists.remove(artist.mbid)
+    assert len(copy.artists) == 0 and len(user.artists) == 1
+    assert pickle.loads(pickle.dumps(artist)).mbid == artist.mbid